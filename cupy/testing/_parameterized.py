@@ -110,6 +110,10 @@ def product(parameter):
 
 def product_dict(*parameters):
     # TODO(kataoka): Add documentation
-    return [
-        {k: v for dic in dicts for k, v in dic.items()}
-        for dicts in itertools.product(*parameters)]
+    result = []
+    for dicts in itertools.product(*parameters):
+        merged = {}
+        for dic in dicts:
+            merged.update(dic)
+        result.append(merged)
+    return result
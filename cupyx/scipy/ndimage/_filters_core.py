@@ -222,7 +222,7 @@ def _generate_nd_kernel(name, pre, found, post, mode, w_shape, int_type,
     size = ('%s xsize_{j}=x.shape()[{j}], ysize_{j} = _raw_y.shape()[{j}]'
             ', xstride_{j}=x.strides()[{j}];' % int_type)
     sizes = [size.format(j=j) for j in range(ndim)]
-    inds = _util._generate_indices_ops(ndim, int_type, offsets)
+    inds = _util._generate_indices_ops(ndim, int_type, tuple(offsets))
     # CArray: remove expr entirely
     expr = ' + '.join([f'ix_{j}' for j in range(ndim)])
 
@@ -237,20 +237,32 @@ def _generate_nd_kernel(name, pre, found, post, mode, w_shape, int_type,
                 ws_pre += 'if (nonzero(wval))'
         ws_post = 'iws++;'
 
+    # pixels whose whole footprint is interior can skip the boundary math
+    # entirely; a single predicate computed up front covers every tap
+    uses_boundary = any(w_shape[j] != 1 for j in range(ndim))
+    if uses_boundary:
+        interior = ' && '.join(
+            [_util._boundary_is_interior_expr(
+                f'ind_{j}', f'xsize_{j}', w_shape[j])
+             for j in range(ndim) if w_shape[j] != 1])
+        inds += f'\n    const bool _nonborder = {interior};'
+
     loops = []
     for j in range(ndim):
         if w_shape[j] == 1:
             # CArray: string becomes 'inds[{j}] = ind_{j};', remove (int_)type
             loops.append(f'{{ {int_type} ix_{j} = ind_{j} * xstride_{j};')
         else:
-            boundary = _util._generate_boundary_condition_ops(
-                mode, f'ix_{j}', f'xsize_{j}', int_type)
+            # the boundary condition is deduplicated into a single inlined
+            # device function (normalization is the identity for in-range
+            # indices in every mode, so interior pixels may skip the call)
+            bound = _util._boundary_helper_name(mode)
             # CArray: last line of string becomes inds[{j}] = ix_{j};
             loops.append(f'''
     for (int iw_{j} = 0; iw_{j} < {w_shape[j]}; iw_{j}++)
     {{
         {int_type} ix_{j} = ind_{j} + iw_{j};
-        {boundary}
+        if (!_nonborder) ix_{j} = {bound}(ix_{j}, xsize_{j});
         ix_{j} *= xstride_{j};
         ''')
 
@@ -258,6 +270,8 @@ def _generate_nd_kernel(name, pre, found, post, mode, w_shape, int_type,
     value = f'(*(X*)&data[{expr}])'
     if mode == 'constant':
         cond = ' || '.join([f'(ix_{j} < 0)' for j in range(ndim)])
+        if uses_boundary:
+            cond = f'(!_nonborder) && ({cond})'
 
     if cval is numpy.nan:
         cval = 'CUDART_NAN'
@@ -307,6 +321,8 @@ def _generate_nd_kernel(name, pre, found, post, mode, w_shape, int_type,
     if has_mask:
         name += '_with_mask'
     preamble = includes + _CAST_FUNCTION + preamble
+    if uses_boundary:
+        preamble += _util._boundary_helpers_src(mode, int_type)
     options += ('--std=c++11', '-DCUPY_USE_JITIFY')
     return cupy.ElementwiseKernel(in_params, out_params, operation, name,
                                   reduce_dims=False, preamble=preamble,
@@ -1,9 +1,35 @@
+import functools
+import math
+import os
+import string
+import sys
+import threading
 import warnings
 
 import numpy
 
 import cupy
 
+# Opt-in reuse of the allocated output buffer across filter calls with
+# identical shape and dtype (e.g. streaming pipelines). Off by default since
+# handing back a previously returned array would be surprising; the refcount
+# guard in _get_cached_output only prevents reuse while the caller still
+# holds a reference.
+_reuse_output = os.environ.get('CUPY_NDIMAGE_REUSE_OUTPUT', '0') != '0'
+_output_cache = threading.local()
+
+
+def _get_cached_output(shape, dtype):
+    buf = getattr(_output_cache, 'buf', None)
+    # three references exist when the buffer is otherwise unused: the
+    # cache slot, the local above and the getrefcount argument
+    if (buf is not None and buf.shape == shape and buf.dtype == dtype
+            and sys.getrefcount(buf) <= 3):
+        return buf
+    buf = cupy.empty(shape, dtype=dtype)
+    _output_cache.buf = buf
+    return buf
+
 
 def _is_integer_output(output, input):
     if output is None:
@@ -14,9 +40,18 @@ def _is_integer_output(output, input):
 
 
 def _check_cval(mode, cval, integer_output):
-    if mode == 'constant' and integer_output and not cupy.isfinite(cval):
-        raise NotImplementedError("Non-finite cval is not supported for "
-                                  "outputs with integer dtype.")
+    if mode == 'constant' and integer_output:
+        try:
+            # testing a scalar on the host avoids a kernel launch
+            finite = math.isfinite(cval)
+        except (TypeError, ValueError):
+            finite = bool(cupy.isfinite(cval))
+        if not finite:
+            raise NotImplementedError("Non-finite cval is not supported for "
+                                      "outputs with integer dtype.")
+
+
+_init_weights_dtype_cache = {}
 
 
 def _init_weights_dtype(input):
@@ -25,18 +60,35 @@ def _init_weights_dtype(input):
     This helper is only used during initialization of some internal filters
     like prewitt and sobel to avoid costly double-precision computation.
     """
-    if input.dtype.kind == "c":
-        return cupy.promote_types(input.real.dtype, cupy.complex64)
-    return cupy.promote_types(input.real.dtype, cupy.float32)
+    # the result only depends on the input dtype, so cache it instead of
+    # going through the type-promotion machinery on every call
+    key = input.dtype.num
+    dtype = _init_weights_dtype_cache.get(key)
+    if dtype is None:
+        if input.dtype.kind == "c":
+            dtype = cupy.promote_types(input.real.dtype, cupy.complex64)
+        else:
+            dtype = cupy.promote_types(input.real.dtype, cupy.float32)
+        _init_weights_dtype_cache[key] = dtype
+    return dtype
+
+
+_get_weights_dtype_cache = {}
 
 
 def _get_weights_dtype(input, weights):
-    if weights.dtype.kind == "c" or input.dtype.kind == "c":
-        return cupy.promote_types(input.real.dtype, cupy.complex64)
-    elif weights.dtype.kind in 'iub':
-        # convert integer dtype weights to double as in SciPy
-        return cupy.float64
-    return cupy.promote_types(input.real.dtype, cupy.float32)
+    key = (input.dtype.num, weights.dtype.num)
+    dtype = _get_weights_dtype_cache.get(key)
+    if dtype is None:
+        if weights.dtype.kind == "c" or input.dtype.kind == "c":
+            dtype = cupy.promote_types(input.real.dtype, cupy.complex64)
+        elif weights.dtype.kind in 'iub':
+            # convert integer dtype weights to double as in SciPy
+            dtype = cupy.float64
+        else:
+            dtype = cupy.promote_types(input.real.dtype, cupy.float32)
+        _get_weights_dtype_cache[key] = dtype
+    return dtype
 
 
 def _get_output(output, input, shape=None, complex_output=False):
@@ -46,7 +98,10 @@ def _get_output(output, input, shape=None, complex_output=False):
             _dtype = cupy.promote_types(input.dtype, cupy.complex64)
         else:
             _dtype = input.dtype
-        output = cupy.empty(shape, dtype=_dtype)
+        if _reuse_output:
+            output = _get_cached_output(shape, _dtype)
+        else:
+            output = cupy.empty(shape, dtype=_dtype)
     elif isinstance(output, (type, cupy.dtype)):
         if complex_output and cupy.dtype(output).kind != 'c':
             warnings.warn("promoting specified output dtype to complex")
@@ -65,8 +120,17 @@ def _get_output(output, input, shape=None, complex_output=False):
 
 
 def _fix_sequence_arg(arg, ndim, name, conv=lambda x: x):
-    if isinstance(arg, str):
+    if isinstance(arg, (int, float, bool, str)):
+        # fast path for the common scalar case; raising and catching the
+        # TypeError below costs far more than this check
         return [conv(arg)] * ndim
+    if isinstance(arg, (tuple, list)):
+        # fast path for the common sequence types: skip the iterator
+        # protocol and validate the length before converting
+        if len(arg) != ndim:
+            raise RuntimeError(
+                "{} must have length equal to input rank".format(name))
+        return [conv(x) for x in arg]
     try:
         arg = iter(arg)
     except TypeError:
@@ -85,78 +149,255 @@ def _check_origin(origin, width):
     return origin
 
 
+_VALID_MODES = frozenset({'reflect', 'constant', 'nearest', 'mirror', 'wrap',
+                          'grid-mirror', 'grid-wrap', 'grid-reflect'})
+
+
 def _check_mode(mode):
-    if mode not in ('reflect', 'constant', 'nearest', 'mirror', 'wrap',
-                    'grid-mirror', 'grid-wrap', 'grid-reflect'):
-        msg = f'boundary mode not supported (actual: {mode})'
-        raise RuntimeError(msg)
+    if mode not in _VALID_MODES:
+        raise RuntimeError(f'boundary mode not supported (actual: {mode})')
     return mode
 
 
-def _get_inttype(input):
+def _get_inttype(input, signed=True):
     # The integer type to use for indices in the input array
     # The indices actually use byte positions and we can't just use
     # input.nbytes since that won't tell us the number of bytes between the
     # first and last elements when the array is non-contiguous
-    nbytes = sum((x-1)*abs(stride) for x, stride in
-                 zip(input.shape, input.strides)) + input.dtype.itemsize
-    return 'int' if nbytes < (1 << 31) else 'ptrdiff_t'
+    itemsize = input.dtype.itemsize
+    if input.flags.forc:
+        # contiguous arrays span exactly size * itemsize bytes
+        nbytes = input.size * itemsize
+    else:
+        shape = numpy.asarray(input.shape, dtype=numpy.int64)
+        strides = numpy.abs(numpy.asarray(input.strides, dtype=numpy.int64))
+        nbytes = int(((shape - 1) * strides).sum()) + itemsize
+    if nbytes < (1 << 31):
+        return 'int'
+    if not signed and nbytes < (1 << 32):
+        # callers whose generated code never forms a negative index (no
+        # negative offsets or pre-normalization intermediates) can keep
+        # 32-bit indexing for arrays up to 4 GiB
+        return 'unsigned int'
+    return 'ptrdiff_t'
+
+
+# Precompiled templates for the boundary condition snippets below.
+# string.Template substitution skips the str.format parser and its
+# $-placeholders leave the braces of the C code unescaped.
+_TPL_REFLECT_FLOAT = string.Template('''
+        if ($ix < 0) {
+            $ix = - 1 -$ix;
+        }
+        $ix %= $xsize * 2;
+        $ix = $min($ix, 2 * $xsize - 1 - $ix);''')
+
+# xsize * 2 is hoisted so that it is computed once even when xsize is a
+# runtime identifier; the scope keeps the temporary from clashing when
+# several boundary blocks are emitted in a row. The xor is branchless:
+# (ix >> n) is -1 exactly when ix is negative (arithmetic shift) and 0
+# otherwise, and ix ^ -1 == -1 - ix, avoiding warp divergence at borders.
+# In the pow2 variant 2 * xsize is also a power of two and ix is
+# non-negative after the xor, so a mask replaces the modulo.
+_TPL_REFLECT = string.Template('''
+        {
+            const $int_t _xs2 = $xsize * 2;
+            $ix ^= $ix >> (sizeof($ix) * 8 - 1);
+            $ix %= _xs2;
+            $ix = min($ix, _xs2 - 1 - $ix);
+        }''')
+_TPL_REFLECT_POW2 = string.Template('''
+        {
+            const $int_t _xs2 = $xsize * 2;
+            $ix ^= $ix >> (sizeof($ix) * 8 - 1);
+            $ix &= _xs2 - 1;
+            $ix = min($ix, _xs2 - 1 - $ix);
+        }''')
+
+_TPL_MIRROR_FLOAT = string.Template('''
+        if ($xsize == 1) {
+            $ix = 0;
+        } else {
+            if ($ix < 0) {
+                $ix = -$ix;
+            }
+            $ix = 1 + ($ix - 1) % (($xsize - 1) * 2);
+            $ix = $min($ix, 2 * $xsize - 2 - $ix);
+        }''')
+
+# abs is a single instruction on CUDA (no divergent branch) and
+# (xsize - 1) * 2 is hoisted for reuse by the fold-back min
+_TPL_MIRROR = string.Template('''
+        if ($xsize == 1) {
+            $ix = 0;
+        } else {
+            const $int_t _szm1_2 = ($xsize - 1) * 2;
+            $ix = abs($ix);
+            $ix = 1 + ($ix - 1) % _szm1_2;
+            $ix = min($ix, _szm1_2 - $ix);
+        }''')
+
+# unsigned indices are never negative; a single clamp suffices
+_TPL_NEAREST_UNSIGNED = string.Template('''
+        $ix = $min($ix, (unsigned int)($xsize - 1));''')
+
+# already 32-bit signed; casts would only add sign-extension moves
+# around the single min/max clamp
+_TPL_NEAREST_INT = string.Template('''
+        $ix = min(max($ix, 0), $xsize - 1);''')
+
+_TPL_NEAREST = string.Template('''
+        $ix = $min($max(($T)$ix, ($T)0), ($T)($xsize - 1));''')
+
+# masking a two's-complement value wraps negatives as well
+_TPL_GRID_WRAP_POW2 = string.Template('''
+        $ix &= $xsize - 1;''')
 
+_TPL_GRID_WRAP_FLOAT = string.Template('''
+        $ix %= $xsize;
+        while ($ix < 0) {
+            $ix += $xsize;
+        }''')
 
+# C remainder takes the sign of the dividend, so at most one correction
+# by xsize is needed; apply it branchlessly (ix >> n is -1 when ix is
+# negative and 0 otherwise)
+_TPL_GRID_WRAP = string.Template('''
+        $ix %= $xsize;
+        $ix += $xsize & ($ix >> (sizeof($ix) * 8 - 1));''')
+
+_TPL_WRAP = string.Template('''
+        if ($ix < 0) {
+            $ix += ($xsize - 1) * (($int_t)(-$ix / ($xsize - 1)) + 1);
+        } else if ($ix > ($xsize - 1)) {
+            $ix -= ($xsize - 1) * ($int_t)($ix / ($xsize - 1));
+        };''')
+
+_TPL_CONSTANT = string.Template('''
+        if (($ix < 0) || $ix >= $xsize) {
+            $ix = -1;
+        }''')
+
+
+@functools.lru_cache(maxsize=None)
 def _generate_boundary_condition_ops(mode, ix, xsize, int_t="int",
-                                     float_ix=False):
-    min_func = "fmin" if float_ix else "min"
-    max_func = "fmax" if float_ix else "max"
+                                     float_ix=False, xsize_is_pow2=False):
+    # When the caller can guarantee that the value of xsize is a power of
+    # two, xsize_is_pow2 replaces the integer modulo (a multi-cycle divide
+    # on the GPU) with a single-cycle bitwise AND.
     if mode in ['reflect', 'grid-mirror']:
-        ops = '''
-        if ({ix} < 0) {{
-            {ix} = - 1 -{ix};
-        }}
-        {ix} %= {xsize} * 2;
-        {ix} = {min}({ix}, 2 * {xsize} - 1 - {ix});'''.format(
-            ix=ix, xsize=xsize, min=min_func)
+        if float_ix:
+            tpl = _TPL_REFLECT_FLOAT
+        elif xsize_is_pow2:
+            tpl = _TPL_REFLECT_POW2
+        else:
+            tpl = _TPL_REFLECT
     elif mode == 'mirror':
-        ops = '''
-        if ({xsize} == 1) {{
-            {ix} = 0;
-        }} else {{
-            if ({ix} < 0) {{
-                {ix} = -{ix};
-            }}
-            {ix} = 1 + ({ix} - 1) % (({xsize} - 1) * 2);
-            {ix} = {min}({ix}, 2 * {xsize} - 2 - {ix});
-        }}'''.format(ix=ix, xsize=xsize, min=min_func)
+        tpl = _TPL_MIRROR_FLOAT if float_ix else _TPL_MIRROR
     elif mode == 'nearest':
-        ops = '''
-        {ix} = {min}({max}(({T}){ix}, ({T})0), ({T})({xsize} - 1));'''.format(
-            ix=ix, xsize=xsize, min=min_func, max=max_func,
-            # force using 64-bit signed integer for ptrdiff_t,
-            # see cupy/cupy#6048
-            T=('int' if int_t == 'int' else 'long long'))
+        if int_t == 'unsigned int' and not float_ix:
+            tpl = _TPL_NEAREST_UNSIGNED
+        elif int_t == 'int' and not float_ix:
+            tpl = _TPL_NEAREST_INT
+        else:
+            tpl = _TPL_NEAREST
     elif mode == 'grid-wrap':
-        ops = '''
-        {ix} %= {xsize};
-        while ({ix} < 0) {{
-            {ix} += {xsize};
-        }}'''.format(ix=ix, xsize=xsize)
+        if float_ix:
+            tpl = _TPL_GRID_WRAP_FLOAT
+        elif xsize_is_pow2:
+            tpl = _TPL_GRID_WRAP_POW2
+        else:
+            tpl = _TPL_GRID_WRAP
     elif mode == 'wrap':
-        ops = '''
-        if ({ix} < 0) {{
-            {ix} += ({sz} - 1) * (({int_t})(-{ix} / ({sz} - 1)) + 1);
-        }} else if ({ix} > ({sz} - 1)) {{
-            {ix} -= ({sz} - 1) * ({int_t})({ix} / ({sz} - 1));
-        }};'''.format(ix=ix, sz=xsize, int_t=int_t)
+        tpl = _TPL_WRAP
     elif mode in ['constant', 'grid-constant']:
-        ops = '''
-        if (({ix} < 0) || {ix} >= {xsize}) {{
-            {ix} = -1;
-        }}'''.format(ix=ix, xsize=xsize)
-    return ops
+        tpl = _TPL_CONSTANT
+    return tpl.substitute(
+        ix=ix, xsize=xsize, int_t=int_t,
+        min='fmin' if float_ix else 'min',
+        max='fmax' if float_ix else 'max',
+        # force using 64-bit signed integer for ptrdiff_t,
+        # see cupy/cupy#6048
+        T='int' if int_t == 'int' else 'long long')
+
+
+def _boundary_is_interior_expr(ix, xsize, wsize):
+    """Generate a predicate that is true when every filter tap starting at
+    {ix} (i.e. {ix} .. {ix} + {wsize} - 1) falls inside [0, {xsize}), so no
+    boundary handling is needed along this axis.
+    """
+    return f'(({ix} >= 0) && ({ix} + {wsize} <= {xsize}))'
+
 
+def _boundary_helper_name(mode):
+    # the C++ overload on the index type keeps the name type-independent
+    return 'cupyx_ndimage_bound_{}'.format(mode.replace('-', '_'))
 
-def _generate_indices_ops(ndim, int_type, offsets):
-    code = '{type} ind_{j} = _i % ysize_{j} - {offset}; _i /= ysize_{j};'
-    body = [code.format(type=int_type, j=j, offset=offsets[j])
-            for j in range(ndim-1, 0, -1)]
+
+@functools.lru_cache(maxsize=None)
+def _boundary_helpers_src(mode, int_t='int', xsize_is_pow2=False):
+    """Generate a __device__ helper wrapping the boundary condition ops.
+
+    Kernels that evaluate the same boundary condition once per filter tap
+    can prepend this helper once and call it instead of re-emitting the
+    snippet inline, which keeps the generated source (and the compiled
+    SASS) small for large footprints.
+    """
+    ops = _generate_boundary_condition_ops(
+        mode, 'ix', 'xsize', int_t, xsize_is_pow2=xsize_is_pow2)
+    return '''
+__device__ __forceinline__ {int_t} {name}({int_t} ix, const {int_t} xsize)
+{{
+    {ops}
+    return ix;
+}}
+'''.format(int_t=int_t, name=_boundary_helper_name(mode), ops=ops)
+
+
+@functools.lru_cache(maxsize=None)
+def _generate_indices_ops(ndim, int_type, offsets, ysizes=None):
+    # offsets (and ysizes, when given) must be tuples for the cache.
+    # ysizes bakes the output extents in as compile-time constants;
+    # power-of-two extents are then unraveled with a mask and shift
+    # instead of the modulo/divide pair (the slowest integer ops on GPU).
+    body = []
+    for j in range(ndim-1, 0, -1):
+        if (ysizes is not None and ysizes[j] > 0
+                and (ysizes[j] & (ysizes[j] - 1)) == 0):
+            code = ('{type} ind_{j} = (_i & {mask}) - {offset}; '
+                    '_i >>= {shift};')
+            body.append(code.format(
+                type=int_type, j=j, offset=offsets[j], mask=ysizes[j] - 1,
+                shift=ysizes[j].bit_length() - 1))
+        else:
+            ysize = f'ysize_{j}' if ysizes is None else ysizes[j]
+            code = '{type} ind_{j} = _i % {ysize} - {offset}; _i /= {ysize};'
+            body.append(code.format(
+                type=int_type, j=j, offset=offsets[j], ysize=ysize))
     return '{type} _i = i;\n{body}\n{type} ind_0 = _i - {offset};'.format(
         type=int_type, body='\n'.join(body), offset=offsets[0])
+
+
+@functools.lru_cache(maxsize=None)
+def _generate_indices_ops_3d(offsets, int_type='int'):
+    """Generate output coordinates from a 3-D launch configuration.
+
+    Raw kernels launched over a 3-D grid get the per-axis coordinates for
+    free from blockIdx/blockDim/threadIdx, avoiding the divide chain that
+    _generate_indices_ops needs to unravel a flat index. Only drivers that
+    control their own launch geometry can use this; ElementwiseKernel
+    always launches a flat 1-D grid and must keep the generic path. The
+    caller is responsible for guarding against out-of-range coordinates
+    when an extent is not a multiple of the block size.
+    """
+    ndim = len(offsets)
+    assert 1 <= ndim <= 3
+    ops = []
+    for j in range(ndim):
+        # ind_0 is the slowest-varying axis; the x component of the launch
+        # maps to the last axis so that warps stay contiguous in memory
+        axis = 'xyz'[ndim - 1 - j]
+        ops.append(
+            f'{int_type} ind_{j} = blockIdx.{axis} * blockDim.{axis}'
+            f' + threadIdx.{axis} - {offsets[j]};')
+    return '\n'.join(ops)